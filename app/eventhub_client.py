@@ -3,11 +3,12 @@ Event Hub Client - Simplified
 Sends data dictionaries to Azure Event Hub (no database dependencies)
 """
 
-import json
 import logging
+import time
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 
+import orjson
 from azure.eventhub import EventHubProducerClient, EventData
 from azure.eventhub.exceptions import EventHubError
 
@@ -24,6 +25,11 @@ class EventHubClient:
     Simplified Azure Event Hub client
     Works with dictionaries instead of ORM objects
     """
+
+    # Transient send failures are retried in-process (1s, 2s, 4s) rather than
+    # failing the invocation, whose host-level retry would re-fetch from Microshare
+    SEND_ATTEMPTS = 4
+    SEND_BACKOFF_SECONDS = 1.0
     
     def __init__(self, config: Dict[str, Any]):
         """
@@ -94,10 +100,10 @@ class EventHubClient:
             properties: Optional custom properties for routing/filtering
         """
         try:
-            producer = self._get_producer()
+            producers = self._get_producers()
             
             # Create Event Data
-            event = EventData(json.dumps(event_data))
+            event = EventData(orjson.dumps(event_data))
             
             # Add properties
             if properties:
@@ -109,8 +115,8 @@ class EventHubClient:
                     'source': 'microshare-forwarder'
                 }
             
-            # Send
-            with producer:
+            # Send to all hubs (producers stay open for reuse; see close())
+            for producer in producers:
                 producer.send_batch([event])
             
             logger.debug(f"Event sent: device_id={event_data.get('device_id')}")
@@ -122,10 +128,100 @@ class EventHubClient:
             logger.error(f"Unexpected error sending to Event Hub: {e}", exc_info=True)
             raise EventHubClientError(f"Unexpected error: {e}")
     
+    @staticmethod
+    def _event_properties(event_data: Dict[str, Any]) -> Dict[str, str]:
+        """Build the routing/filtering properties attached to each event"""
+        properties = {
+            'device_id': event_data.get('device_id', ''),
+            'source': 'microshare-forwarder'
+        }
+
+        if 'location' in event_data and 'building' in event_data['location']:
+            properties['building'] = event_data['location']['building']
+
+        return properties
+
+    def _send_packed(self, producer: EventHubProducerClient, payloads: List[tuple]) -> int:
+        """
+        Pack pre-serialized events into size-bounded EventDataBatch objects and send them
+
+        Transient Event Hub errors are retried here, per hub, with exponential
+        backoff. A retry resumes after the events this hub has already accepted,
+        so neither this hub nor any other hub receives duplicates.
+
+        Args:
+            producer: Producer for one Event Hub
+            payloads: List of (json_bytes, properties) tuples
+
+        Returns:
+            Number of batches sent
+        """
+        batches_sent = 0
+        # Number of payloads (from the start) this hub has accepted
+        delivered = 0
+
+        for attempt in range(self.SEND_ATTEMPTS):
+            try:
+                batch = producer.create_batch()
+                in_batch = 0
+
+                for body, properties in payloads[delivered:]:
+                    event = EventData(body)
+                    event.properties = properties
+
+                    # Respect the configured event count per batch as well as the byte limit
+                    if in_batch >= self.max_batch_size:
+                        producer.send_batch(batch)
+                        batches_sent += 1
+                        delivered += in_batch
+                        batch = producer.create_batch()
+                        in_batch = 0
+
+                    try:
+                        batch.add(event)
+                    except ValueError:
+                        # Batch is full (max_size_in_bytes): ship it and start a new one
+                        if in_batch == 0:
+                            raise EventHubClientError(
+                                f"Event of {len(body)} bytes exceeds the maximum Event Hub batch size"
+                            )
+                        producer.send_batch(batch)
+                        batches_sent += 1
+                        delivered += in_batch
+                        batch = producer.create_batch()
+                        in_batch = 0
+                        try:
+                            batch.add(event)
+                        except ValueError:
+                            raise EventHubClientError(
+                                f"Event of {len(body)} bytes exceeds the maximum Event Hub batch size"
+                            )
+                    in_batch += 1
+
+                if in_batch:
+                    producer.send_batch(batch)
+                    batches_sent += 1
+                    delivered += in_batch
+
+                return batches_sent
+
+            except EventHubError as e:
+                if attempt == self.SEND_ATTEMPTS - 1:
+                    raise
+                delay = self.SEND_BACKOFF_SECONDS * 2 ** attempt
+                logger.warning(
+                    f"Event Hub send failed after {delivered}/{len(payloads)} events "
+                    f"(attempt {attempt + 1}/{self.SEND_ATTEMPTS}), retrying in {delay:.0f}s: {e}"
+                )
+                time.sleep(delay)
+
     def send_events_batch(self, events: List[Dict[str, Any]]) -> int:
         """
         Send multiple events to ALL configured Event Hubs in batches
 
+        Events are packed into EventDataBatch objects created by each producer, so
+        each batch is as full as the hub's frame size (and batch_size) allows.
+
         Args:
             events: List of event data dictionaries
 
@@ -139,50 +235,30 @@ class EventHubClient:
         try:
             producers = self._get_producers()
 
-            total_sent = 0
-            batch_count = 0
-
-            # Process in batches
-            for i in range(0, len(events), self.max_batch_size):
-                batch = events[i:i + self.max_batch_size]
-                batch_count += 1
+            # Serialize once (orjson yields UTF-8 bytes directly), reuse for every hub
+            payloads = [
+                (orjson.dumps(event_data), self._event_properties(event_data))
+                for event_data in events
+            ]
 
-                # Create event batch
-                event_batch = []
-                for event_data in batch:
-                    event = EventData(json.dumps(event_data))
+            if len(producers) > 1:
+                logger.info(f"Sending {len(payloads)} events to {len(producers)} Event Hubs simultaneously")
 
-                    # Add properties
-                    event.properties = {
-                        'device_id': event_data.get('device_id', ''),
-                        'source': 'microshare-forwarder'
-                    }
-
-                    if 'location' in event_data and 'building' in event_data['location']:
-                        event.properties['building'] = event_data['location']['building']
-
-                    event_batch.append(event)
-
-                # Send batch to ALL Event Hubs
+            # Producers stay open across batches and invocations; see close()
+            batch_count = 0
+            for hub_idx, producer in enumerate(producers):
+                batch_count = self._send_packed(producer, payloads)
                 if len(producers) > 1:
-                    logger.info(f"Sending batch {batch_count} with {len(event_batch)} events to {len(producers)} Event Hubs simultaneously")
+                    logger.info(f"  ✓ Hub {hub_idx + 1}/{len(producers)}: {len(payloads)} events delivered in {batch_count} batches")
                 else:
-                    logger.debug(f"Sending batch {batch_count} with {len(event_batch)} events to {len(producers)} hub(s)")
-
-                for hub_idx, producer in enumerate(producers):
-                    with producer:
-                        producer.send_batch(event_batch)
-                    if len(producers) > 1:
-                        logger.info(f"  ✓ Hub {hub_idx + 1}/{len(producers)}: Batch {batch_count} delivered")
-                    else:
-                        logger.debug(f"  → Hub {hub_idx + 1}: Batch {batch_count} sent")
-
-                total_sent += len(batch)
-                logger.info(f"Batch {batch_count} sent: {len(batch)} events")
+                    logger.debug(f"  → Hub {hub_idx + 1}: {len(payloads)} events sent in {batch_count} batches")
 
+            total_sent = len(payloads)
             logger.info(f"Successfully sent {total_sent} events in {batch_count} batches to {len(producers)} Event Hub(s)")
             return total_sent
 
+        except EventHubClientError:
+            raise
         except EventHubError as e:
             logger.error(f"Event Hub error while sending batch: {e}")
             raise EventHubClientError(f"Event Hub batch send failed: {e}")
@@ -198,7 +274,7 @@ class EventHubClient:
             True if connection successful, False otherwise
         """
         try:
-            producer = self._get_producer()
+            producer = self._get_producers()[0]
             
             # Send a test event
             test_data = {
@@ -207,11 +283,10 @@ class EventHubClient:
                 'message': 'Connection test from Microshare Forwarder'
             }
             
-            event = EventData(json.dumps(test_data))
+            event = EventData(orjson.dumps(test_data))
             event.properties = {'source': 'microshare-forwarder', 'test': True}
             
-            with producer:
-                producer.send_batch([event])
+            producer.send_batch([event])
             
             logger.info("✓ Event Hub connection test successful")
             return True
@@ -6,11 +6,14 @@ Fetches occupancy snapshots from Microshare API without database dependencies
 import logging
 import json
 import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Deque, Dict, Iterator, List, Optional, Any, Tuple
 from urllib.parse import urljoin
 from pathlib import Path
 
+import orjson
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -18,6 +21,16 @@ from urllib3.util.retry import Retry
 logger = logging.getLogger(__name__)
 
 
+def _api_timestamp(dt: datetime, suffix: str) -> str:
+    """
+    Format a datetime as the API expects, e.g. 2025-11-14T10:00:00.000Z
+
+    Same output as strftime("%Y-%m-%dT%H:%M:%S" + suffix), without the
+    locale-aware strftime path. Any tzinfo is ignored (times are UTC).
+    """
+    return dt.replace(microsecond=0, tzinfo=None).isoformat() + suffix
+
+
 class MicroshareAPIError(Exception):
     """Base exception for Microshare API errors"""
     pass
@@ -38,6 +51,21 @@ class MicroshareClient:
     
     WEB_LOGIN_URL = "https://app.microshare.io/login"
     API_BASE_URL = "https://api.microshare.io/share"
+    # Aggregated endpoint behind the dashboard views and hourly snapshots
+    AGG_URL = "https://api.microshare.io/share/io.microshare.fm.master.agg/"
+
+    # Shared across all instances: one adapter means one urllib3 PoolManager
+    # per process, so keep-alive connections survive client re-creation
+    _RETRY = Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["HEAD", "GET", "POST", "OPTIONS"])
+    )
+    _ADAPTER = HTTPAdapter(max_retries=_RETRY, pool_connections=32, pool_maxsize=32)
+
+    # Upper bound on dashboard queries in flight at once (per-location fan-out)
+    MAX_CONCURRENT_QUERIES = 8
     
     def __init__(self, config: Dict[str, Any]):
         """
@@ -67,19 +95,10 @@ class MicroshareClient:
         logger.info("MicroshareClient initialized")
     
     def _create_session(self) -> requests.Session:
-        """Create requests session with retry logic"""
+        """Create requests session mounted on the shared retrying adapter"""
         session = requests.Session()
-        
-        retry_strategy = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["HEAD", "GET", "POST", "OPTIONS"]
-        )
-        
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        session.mount("https://", adapter)
-        session.mount("http://", adapter)
+        session.mount("https://", self._ADAPTER)
+        session.mount("http://", self._ADAPTER)
         
         return session
     
@@ -96,7 +115,7 @@ class MicroshareClient:
                         self._token_expires_at = datetime.fromisoformat(expires_at_str)
                         
                         # Check if token is still valid (with 5 min buffer)
-                        if datetime.utcnow() < self._token_expires_at - timedelta(minutes=5):
+                        if self._token_is_valid():
                             logger.info("Loaded valid token from cache")
                             return True
         except Exception as e:
@@ -124,9 +143,20 @@ class MicroshareClient:
         except Exception as e:
             logger.warning(f"Error saving token to file: {e}")
     
+    def _token_is_valid(self) -> bool:
+        """Check the in-memory token is set and not within 5 minutes of expiry"""
+        return bool(
+            self._token and self._token_expires_at and
+            datetime.utcnow() < self._token_expires_at - timedelta(minutes=5)
+        )
+
     def _get_token(self) -> str:
-        """Get valid OAuth token (from cache or new via web login)"""
-        # Try to load from file first
+        """Get valid OAuth token (from memory, file cache, or new via web login)"""
+        # Token already held by this client (the client lives for the whole worker process)
+        if self._token_is_valid():
+            return self._token
+
+        # Then try the file cache
         if self._load_token_from_file():
             return self._token
 
@@ -251,7 +281,7 @@ class MicroshareClient:
             response = self.session.get(url, params=params, headers=headers, timeout=30)
             response.raise_for_status()
 
-            cluster_data = response.json()
+            cluster_data = orjson.loads(response.content)
             objs = cluster_data.get('objs', [])
 
             if not objs:
@@ -289,7 +319,7 @@ class MicroshareClient:
 
             return location_list
 
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             logger.error(f"Failed to discover locations via Device Cluster API: {e}")
             raise MicroshareAPIError(f"Failed to discover locations: {e}")
 
@@ -320,7 +350,7 @@ class MicroshareClient:
             "Content-Type": "application/json"
         }
 
-        url = "https://api.microshare.io/share/io.microshare.fm.master.agg/"
+        url = self.AGG_URL
 
         try:
             response = self.session.get(
@@ -330,13 +360,63 @@ class MicroshareClient:
                 timeout=30
             )
             response.raise_for_status()
-            return response.json()
+            return orjson.loads(response.content)
 
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             loc_info = f" for location '{location_name}'" if location_name else ""
             logger.error(f"Dashboard API query failed{loc_info}: {e}")
             raise MicroshareAPIError(f"Dashboard API query failed{loc_info}: {e}")
 
+    def _query_dashboard_api_many(
+        self,
+        queries: List[Tuple[Dict[str, Any], str]]
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Run several dashboard queries concurrently.
+
+        Per-location queries are independent and I/O bound, so they are issued
+        from a small thread pool sharing this client's connection pool. Besides
+        the result being yielded, at most MAX_CONCURRENT_QUERIES queries are in
+        flight or waiting to be consumed; the next one is submitted as each
+        result is yielded, so a slow consumer holds back fetching instead of
+        buffering every response.
+
+        Args:
+            queries: List of (params, location_name) tuples for _query_dashboard_api
+
+        Yields:
+            API responses, in the same order as queries
+
+        Raises:
+            MicroshareAPIError: If any of the API requests fails
+        """
+        if not queries:
+            return
+
+        # Resolve the token once up front so workers all hit the cache
+        self._get_token()
+
+        workers = min(self.MAX_CONCURRENT_QUERIES, len(queries))
+        remaining = iter(queries)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            window: Deque[Future] = deque()
+
+            def submit_next():
+                query = next(remaining, None)
+                if query is not None:
+                    params, location_name = query
+                    window.append(
+                        pool.submit(self._query_dashboard_api, params, location_name=location_name)
+                    )
+
+            for _ in range(workers):
+                submit_next()
+            while window:
+                result = window.popleft().result()
+                # Keep the pool busy while the caller handles this result
+                submit_next()
+                yield result
+
     def get_snapshots_in_range(
         self,
         from_time: datetime,
@@ -364,8 +444,8 @@ class MicroshareClient:
         token = self._get_token()
 
         # Format timestamps for API
-        from_str = from_time.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        to_str = to_time.strftime("%Y-%m-%dT%H:%M:%S.999Z")
+        from_str = _api_timestamp(from_time, ".000Z")
+        to_str = _api_timestamp(to_time, ".999Z")
 
         # Get config parameters
         ms_config = self.config.get('microshare', {})
@@ -412,7 +492,7 @@ class MicroshareClient:
         }
 
         # Use aggregated endpoint for hourly snapshots
-        url = "https://api.microshare.io/share/io.microshare.fm.master.agg/"
+        url = self.AGG_URL
 
         logger.info(f"Fetching snapshots from {from_str} to {to_str}")
 
@@ -434,7 +514,7 @@ class MicroshareClient:
                 )
 
                 response.raise_for_status()
-                data = response.json()
+                data = orjson.loads(response.content)
 
                 # Extract snapshots and metadata
                 snapshots = data.get('objs', [])
@@ -477,7 +557,7 @@ class MicroshareClient:
 
             return transformed
 
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
             logger.error(f"API request failed on page {page}: {e}")
             raise MicroshareAPIError(f"Failed to fetch snapshots: {e}")
 
@@ -489,6 +569,28 @@ class MicroshareClient:
         """
         Get full 24-hour people counter data with identity filtering.
 
+        Collects every page from iter_people_counter_full_coverage().
+
+        Args:
+            from_time: Start time (inclusive)
+            to_time: End time (inclusive)
+
+        Returns:
+            List of flattened people counter events with full 24h coverage
+        """
+        all_events = []
+        for location_events in self.iter_people_counter_full_coverage(from_time, to_time):
+            all_events.extend(location_events)
+        return all_events
+
+    def iter_people_counter_full_coverage(
+        self,
+        from_time: datetime,
+        to_time: datetime
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Stream full 24-hour people counter data with identity filtering, one location at a time.
+
         Strategy:
         1. Query Device Cluster API to discover locations (filtered by owner.org)
         2. Query dashboard view per location for full 24h coverage
@@ -498,8 +600,8 @@ class MicroshareClient:
             from_time: Start time (inclusive)
             to_time: End time (inclusive)
 
-        Returns:
-            List of flattened people counter events with full 24h coverage
+        Yields:
+            List of flattened people counter events for one location
         """
         ms_config = self.config.get('microshare', {})
         identity_filter = ms_config.get('identity', '')
@@ -508,8 +610,8 @@ class MicroshareClient:
         logger.info(f"Getting full people counter coverage with identity filter: {identity_filter}")
 
         # Format timestamps for API
-        from_str = from_time.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        to_str = to_time.strftime("%Y-%m-%dT%H:%M:%S.999Z")
+        from_str = _api_timestamp(from_time, ".000Z")
+        to_str = _api_timestamp(to_time, ".999Z")
 
         try:
             # Step 1: Discover locations via Device Cluster API
@@ -518,57 +620,66 @@ class MicroshareClient:
 
             if not locations_for_identity:
                 logger.warning("No locations discovered for the given identity filter")
-                return []
+                return
 
             logger.info(f"Discovered {len(locations_for_identity)} location(s) for identity '{identity_filter}': {locations_for_identity}")
 
             # Step 2: Query dashboard view for each location
-            all_events = []
+            total_events = 0
+            pc_rec_type = pc_config.get('rec_type', 'io.microshare.peoplecounter.unpacked.event.agg')
+
+            # Get data_context and ensure it's a JSON string (not a list)
+            pc_data_context = pc_config.get('data_context', '["people"]')
+            if isinstance(pc_data_context, list):
+                pc_data_context = json.dumps(pc_data_context)
+
+            # Dashboard query parameters shared by every location
+            base_params = {
+                "id": pc_config.get('dashboard_view_id'),
+                "recType": pc_rec_type,
+                "from": from_str,
+                "to": to_str,
+                "dataContext": pc_data_context,
+                "field1": "daily_total",
+                "field2": "meta",
+                "field3": "change",
+                "field4": "field4",
+                "field5": "field5",
+                "field6": "field6"
+            }
 
+            queries = []
             for location in locations_for_identity:
                 logger.info(f"Querying dashboard view for location: {location}")
+                queries.append(({**base_params, "loc1": location}, location))
 
-                # Get data_context and ensure it's a JSON string (not a list)
-                pc_data_context = pc_config.get('data_context', '["people"]')
-                if isinstance(pc_data_context, list):
-                    pc_data_context = json.dumps(pc_data_context)
-
-                # Build dashboard query parameters
-                dashboard_params = {
-                    "id": pc_config.get('dashboard_view_id'),
-                    "recType": pc_config.get('rec_type', 'io.microshare.peoplecounter.unpacked.event.agg'),
-                    "from": from_str,
-                    "to": to_str,
-                    "dataContext": pc_data_context,
-                    "field1": "daily_total",
-                    "field2": "meta",
-                    "field3": "change",
-                    "field4": "field4",
-                    "field5": "field5",
-                    "field6": "field6",
-                    "loc1": location
-                }
-
-                # Query dashboard API using common helper
-                dashboard_data = self._query_dashboard_api(dashboard_params, location_name=location)
+            # Query dashboard API for all locations concurrently, consume in order
+            responses = self._query_dashboard_api_many(queries)
+            for location, dashboard_data in zip(locations_for_identity, responses):
                 dashboard_records = dashboard_data.get('objs', [])
 
                 # Step 3: Flatten line[] arrays
+                location_events = []
                 for dr in dashboard_records:
-                    line_entries = dr.get('data', {}).get('line', [])
+                    data = dr.get('data', {})
+                    line_entries = data.get('line', [])
+                    tags = data.get('_id', {}).get('tags', [])
 
                     # Each entry in line[] is a time-series event
                     for entry in line_entries:
                         # Add metadata from parent record
-                        entry['_location_tags'] = dr.get('data', {}).get('_id', {}).get('tags', [])
+                        entry['_location_tags'] = tags
                         # Add recType for client routing/processing
-                        entry['recType'] = pc_config.get('rec_type', 'io.microshare.peoplecounter.unpacked.event.agg')
-                        all_events.append(entry)
+                        entry['recType'] = pc_rec_type
+
+                    # extend() grows the list once per record instead of once per entry
+                    location_events.extend(line_entries)
 
-                logger.info(f"  → Added {len(line_entries) if dashboard_records else 0} events from {location}")
+                logger.info(f"  → Added {len(location_events)} events from {location}")
+                total_events += len(location_events)
+                yield location_events
 
-            logger.info(f"Total events retrieved: {len(all_events)}")
-            return all_events
+            logger.info(f"Total events retrieved: {total_events}")
 
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to get full people counter coverage: {e}")
@@ -582,18 +693,39 @@ class MicroshareClient:
         """
         Get full 24-hour snapshot data with identity filtering.
 
+        Collects every page from iter_snapshot_full_coverage().
+
+        Args:
+            from_time: Start time (inclusive)
+            to_time: End time (inclusive)
+
+        Returns:
+            List of complete snapshot API responses, one per location
+        """
+        all_snapshots = []
+        for location_responses in self.iter_snapshot_full_coverage(from_time, to_time):
+            all_snapshots.extend(location_responses)
+        return all_snapshots
+
+    def iter_snapshot_full_coverage(
+        self,
+        from_time: datetime,
+        to_time: datetime
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Stream full 24-hour snapshot data with identity filtering, one location at a time.
+
         Strategy:
         1. Query Device Cluster API to discover locations (filtered by owner.org)
         2. Map location names (removes configured prefix from people counter location names)
         3. Query snapshot dashboard view per mapped location for full 24h coverage
-        4. Flatten line[] arrays into individual snapshot entries
 
         Args:
             from_time: Start time (inclusive)
             to_time: End time (inclusive)
 
-        Returns:
-            List of flattened snapshot entries with full 24h coverage
+        Yields:
+            Single-item list holding the complete snapshot API response for one location
         """
         ms_config = self.config.get('microshare', {})
         identity_filter = ms_config.get('identity', '')
@@ -601,8 +733,8 @@ class MicroshareClient:
         logger.info(f"Getting full snapshot coverage with identity filter: {identity_filter}")
 
         # Format timestamps for API
-        from_str = from_time.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        to_str = to_time.strftime("%Y-%m-%dT%H:%M:%S.999Z")
+        from_str = _api_timestamp(from_time, ".000Z")
+        to_str = _api_timestamp(to_time, ".999Z")
 
         try:
             # Step 1: Discover locations via Device Cluster API
@@ -611,7 +743,7 @@ class MicroshareClient:
 
             if not pc_locations:
                 logger.warning("No locations discovered for the given identity filter")
-                return []
+                return
 
             logger.info(f"Discovered {len(pc_locations)} location(s) for identity '{identity_filter}': {pc_locations}")
 
@@ -630,41 +762,44 @@ class MicroshareClient:
             logger.info(f"Location mapping (PC → Snapshot): {snapshot_locations}")
 
             # Step 3: Query snapshot dashboard for each mapped location
-            all_snapshots = []
+            response_count = 0
 
             # Get snapshot config
             snapshot_config = ms_config.get('snapshot', {})
 
+            # Get data_context and ensure it's a JSON string (not a list)
+            data_context = snapshot_config.get('data_context', '[]')
+            if isinstance(data_context, list):
+                data_context = json.dumps(data_context)
+
+            snapshot_rec_type = snapshot_config.get('rec_type', 'io.microshare.lake.snapshot.hourly')
+
+            # Snapshot query parameters shared by every location
+            base_params = {
+                "id": snapshot_config.get('dashboard_view_id'),
+                "recType": snapshot_rec_type,
+                "from": from_str,
+                "to": to_str,
+                "dataContext": data_context,
+                "field1": "current",
+                "field2": "field2",
+                "field3": "field3",
+                "field4": "field4",
+                "field5": "field5",
+                "field6": "field6",
+                "category": snapshot_config.get('category', 'space'),
+                "metric": snapshot_config.get('metric', 'occupancy'),
+                "ownerOrg": snapshot_config.get('owner_org', '"[a-zA-Z]"')
+            }
+
+            queries = []
             for pc_loc, snapshot_loc in snapshot_locations:
                 logger.info(f"Querying snapshot dashboard for location: {snapshot_loc} (from PC: {pc_loc})")
+                queries.append(({**base_params, "loc1": snapshot_loc}, snapshot_loc))
 
-                # Get data_context and ensure it's a JSON string (not a list)
-                data_context = snapshot_config.get('data_context', '[]')
-                if isinstance(data_context, list):
-                    data_context = json.dumps(data_context)
-
-                # Build snapshot query parameters
-                snapshot_params = {
-                    "id": snapshot_config.get('dashboard_view_id'),
-                    "recType": snapshot_config.get('rec_type', 'io.microshare.lake.snapshot.hourly'),
-                    "from": from_str,
-                    "to": to_str,
-                    "dataContext": data_context,
-                    "field1": "current",
-                    "field2": "field2",
-                    "field3": "field3",
-                    "field4": "field4",
-                    "field5": "field5",
-                    "field6": "field6",
-                    "category": snapshot_config.get('category', 'space'),
-                    "metric": snapshot_config.get('metric', 'occupancy'),
-                    "ownerOrg": snapshot_config.get('owner_org', '"[a-zA-Z]"'),
-                    "loc1": snapshot_loc
-                }
-
-                # Query dashboard API using common helper
-                full_response = self._query_dashboard_api(snapshot_params, location_name=snapshot_loc)
-
+            # Query dashboard API for all locations concurrently, consume in order
+            responses = self._query_dashboard_api_many(queries)
+            for (pc_loc, snapshot_loc), full_response in zip(snapshot_locations, responses):
                 # Count events for logging
                 event_count = sum(
                     len(obj.get('data', {}).get('line', []))
@@ -672,15 +807,15 @@ class MicroshareClient:
                 )
 
                 # Add recType for client routing/processing
-                full_response['recType'] = snapshot_config.get('rec_type', 'io.microshare.lake.snapshot.hourly')
-
-                # Add the complete response to the list (not flattened)
-                all_snapshots.append(full_response)
+                full_response['recType'] = snapshot_rec_type
 
                 logger.info(f"  → Retrieved complete response with {event_count} events from {snapshot_loc}")
 
-            logger.info(f"Total snapshot responses retrieved: {len(all_snapshots)}")
-            return all_snapshots
+                # Hand over the complete response (not flattened)
+                response_count += 1
+                yield [full_response]
+
+            logger.info(f"Total snapshot responses retrieved: {response_count}")
 
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to get full snapshot coverage: {e}")
@@ -3,12 +3,17 @@ Simple JSON-based state management
 Replaces database with lightweight file-based persistence
 """
 
-import json
+import atexit
 import logging
+import mmap
+import os
+from collections import OrderedDict, deque
 from pathlib import Path
-from datetime import datetime
-from typing import Dict, List, Optional, Set
-from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Set
+from dataclasses import dataclass
+
+import orjson
 
 logger = logging.getLogger(__name__)
 
@@ -24,25 +29,77 @@ class ForwarderState:
     last_success_timestamp: Optional[str] = None
     last_error_timestamp: Optional[str] = None
     last_error_message: Optional[str] = None
-    devices_tracked: List[str] = None
+    devices_tracked: "OrderedDict[str, None]" = None
     # Pagination tracking
     total_pages_fetched: int = 0
     max_pages_in_single_fetch: int = 0
     last_pagination_warning: Optional[str] = None
+    # Sequence number of the last journal record folded into this state
+    last_journal_seq: int = 0
 
     def __post_init__(self):
-        if self.devices_tracked is None:
-            self.devices_tracked = []
+        # Held in memory as an LRU-ordered key set (least recently seen first);
+        # persisted as a list in the same order
+        self.devices_tracked = OrderedDict.fromkeys(self.devices_tracked or ())
+
+
+# fdatasync skips flushing inode metadata; not available on every platform
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _fsync_directory(path: Path):
+    """fsync a directory so renames/unlinks inside it survive a crash"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on some platforms (e.g. Windows)
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _json_default(obj):
+    """orjson fallback for types it does not serialize natively"""
+    if isinstance(obj, OrderedDict):
+        return list(obj)
+    raise TypeError
 
 
 class StateManager:
-    """Manages forwarder state using JSON file"""
+    """
+    Manages forwarder state using JSON file
+
+    Each update is appended as one line to a journal next to the state file
+    (<state file>.log); the journal is compacted into the JSON file every
+    COMPACT_EVERY records, at exit, and after replaying it on load.
+    """
+
+    # Journal records appended before they are compacted into the state file
+    COMPACT_EVERY = 100
+    # Keys every journal record carries
+    _RECORD_FIELDS = frozenset((
+        "seq", "at", "fetch_timestamp", "snapshots_sent", "duplicates_skipped",
+        "last_snapshot_id", "devices", "success", "error_message", "pages_fetched"
+    ))
+    # Number of recent snapshot IDs remembered for duplicate detection
+    RECENT_IDS_MAX = 1000
+    # Upper bound on devices_tracked; least recently seen devices are dropped
+    DEVICES_TRACKED_MAX = 10000
     
     def __init__(self, state_file_path: str = "/var/lib/microshare-forwarder/state.json"):
         self.state_file_path = Path(state_file_path)
         self.state = ForwarderState()
         self._recent_snapshot_ids: Set[int] = set()
+        # Insertion order of _recent_snapshot_ids, oldest first
+        self._recent_snapshot_order: Deque[int] = deque(maxlen=self.RECENT_IDS_MAX)
+        self.journal_path = self.state_file_path.with_name(self.state_file_path.name + '.log')
+        self._pending_records = 0
         self._load_state()
+        self._replay_journal()
+        # Fold the journal into the state file before the process exits
+        atexit.register(self.flush)
     
     def _ensure_directory(self):
         """Ensure state directory exists"""
@@ -52,43 +109,146 @@ class StateManager:
         """Load state from JSON file"""
         try:
             if self.state_file_path.exists():
-                with open(self.state_file_path, 'r') as f:
-                    data = json.load(f)
-                    self.state = ForwarderState(**data)
-                    logger.info(f"Loaded state from {self.state_file_path}")
-                    logger.info(f"Last fetch: {self.state.last_fetch_timestamp}, "
-                              f"Total sent: {self.state.total_snapshots_sent}")
+                # Map the file and parse it in place instead of copying it into a bytes object
+                with open(self.state_file_path, 'rb') as f:
+                    try:
+                        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    except ValueError:
+                        # mmap refuses empty files
+                        logger.warning(f"State file {self.state_file_path} is empty, starting with empty state")
+                        self.state = ForwarderState()
+                        return
+                    with mm, memoryview(mm) as view:
+                        data = orjson.loads(view)
+                self.state = ForwarderState(**data)
+                logger.info(f"Loaded state from {self.state_file_path}")
+                logger.info(f"Last fetch: {self.state.last_fetch_timestamp}, "
+                          f"Total sent: {self.state.total_snapshots_sent}")
+            elif self.journal_path.exists():
+                # Saving here would delete the journal before it is replayed;
+                # _replay_journal compacts it into a new state file instead
+                logger.info("No existing state file, rebuilding state from journal")
             else:
                 logger.info("No existing state file, starting fresh")
                 self._save_state()
+        except orjson.JSONDecodeError as e:
+            logger.error(f"State file is not valid JSON: {e}, starting with empty state")
+            self.state = ForwarderState()
         except Exception as e:
             logger.error(f"Error loading state: {e}, starting with empty state")
             self.state = ForwarderState()
     
+    def _replay_journal(self):
+        """
+        Apply journal records written after the last compaction, then compact
+
+        A torn final line (crash mid-append) is dropped. Any other unreadable or
+        malformed record stops the replay and the journal is moved aside to
+        <journal>.corrupt-<timestamp> rather than compacted away, so the records
+        that were not applied remain available for manual recovery.
+        """
+        if not self.journal_path.exists():
+            return
+        replayed = 0
+        try:
+            with open(self.journal_path, 'rb') as f:
+                lines = f.readlines()
+            for index, line in enumerate(lines):
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    if index != len(lines) - 1:
+                        raise
+                    # Torn final write from a crash; everything before it is intact
+                    logger.warning(f"Ignoring torn final record in {self.journal_path}")
+                    break
+                # Records up to last_journal_seq are already in the state file
+                if record['seq'] > self.state.last_journal_seq:
+                    self._apply_record(record)
+                    replayed += 1
+        except Exception as e:
+            aside = self.journal_path.with_name(
+                f"{self.journal_path.name}.corrupt-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}"
+            )
+            logger.error(
+                f"Error replaying state journal after {replayed} record(s): {e}; "
+                f"keeping it as {aside}"
+            )
+            os.replace(self.journal_path, aside)
+        if replayed:
+            logger.info(f"Replayed {replayed} journal record(s) from {self.journal_path}")
+        self._save_state()
+
+    def _append_journal(self, record: Dict):
+        """Append one record to the journal and make it durable"""
+        try:
+            self._ensure_directory()
+            fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                view = memoryview(orjson.dumps(record) + b'\n')
+                while view:
+                    view = view[os.write(fd, view):]
+                _fdatasync(fd)
+            finally:
+                os.close(fd)
+            self._pending_records += 1
+        except Exception as e:
+            logger.error(f"Error appending to state journal: {e}")
+            # Fall back to rewriting the whole state file
+            self._save_state()
+
     def _save_state(self):
-        """Save state to JSON file"""
+        """Save state to JSON file (write to temp file, then atomic rename)"""
+        tmp_path = self.state_file_path.with_name(self.state_file_path.name + '.tmp')
         try:
             self._ensure_directory()
-            with open(self.state_file_path, 'w') as f:
-                json.dump(asdict(self.state), f, indent=2)
+            # orjson serializes the dataclass directly, no asdict() copy needed;
+            # compact output since the file is only read by this class
+            data = orjson.dumps(
+                self.state,
+                default=_json_default,
+                option=orjson.OPT_PASSTHROUGH_SUBCLASS
+            )
+            # Unbuffered fd: the whole blob goes out in a single write() syscall
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                # Contents must be on disk before the rename can be
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            # Readers never observe a half-written state file
+            os.replace(tmp_path, self.state_file_path)
+            # Make the rename itself durable before the journal goes away
+            _fsync_directory(self.state_file_path.parent)
+            # Every journal record is now durably in the state file (and skipped
+            # by seq on replay should we crash before the unlink)
+            self.journal_path.unlink(missing_ok=True)
+            self._pending_records = 0
             logger.debug(f"State saved to {self.state_file_path}")
         except Exception as e:
             logger.error(f"Error saving state: {e}")
+
+    def flush(self):
+        """Compact pending journal records into the state file, if any"""
+        if self._pending_records:
+            self._save_state()
     
     def is_duplicate(self, snapshot_id: int) -> bool:
         """
         Check if snapshot ID is a duplicate
-        Uses in-memory set for fast lookups
+        Uses in-memory set for fast lookups, with FIFO eviction of the oldest ID
         """
         if snapshot_id in self._recent_snapshot_ids:
             return True
         
-        # Keep only recent IDs in memory (last 1000)
-        if len(self._recent_snapshot_ids) > 1000:
-            # Remove oldest half
-            sorted_ids = sorted(self._recent_snapshot_ids)
-            self._recent_snapshot_ids = set(sorted_ids[500:])
+        # Keep only recent IDs in memory; the deque drops its oldest entry on append
+        if len(self._recent_snapshot_order) == self.RECENT_IDS_MAX:
+            self._recent_snapshot_ids.discard(self._recent_snapshot_order[0])
         
+        self._recent_snapshot_order.append(snapshot_id)
         self._recent_snapshot_ids.add(snapshot_id)
         return False
     
@@ -105,23 +265,19 @@ class StateManager:
         total_records: Optional[int] = None
     ):
         """Update state after a fetch operation"""
-        self.state.last_fetch_timestamp = fetch_timestamp
-        self.state.total_snapshots_sent += snapshots_sent
-        self.state.total_duplicates_skipped += duplicates_skipped
-
-        if last_snapshot_id:
-            self.state.last_snapshot_id = last_snapshot_id
-
-        if devices:
-            # Update devices list (union)
-            existing = set(self.state.devices_tracked)
-            new_devices = set(devices)
-            self.state.devices_tracked = list(existing.union(new_devices))
-
-        # Track pagination metrics
-        self.state.total_pages_fetched += pages_fetched
-        if pages_fetched > self.state.max_pages_in_single_fetch:
-            self.state.max_pages_in_single_fetch = pages_fetched
+        record = {
+            "seq": self.state.last_journal_seq + 1,
+            "at": datetime.now(timezone.utc).isoformat(),
+            "fetch_timestamp": fetch_timestamp,
+            "snapshots_sent": snapshots_sent,
+            "duplicates_skipped": duplicates_skipped,
+            "last_snapshot_id": last_snapshot_id,
+            "devices": devices,
+            "success": success,
+            "error_message": error_message,
+            "pages_fetched": pages_fetched
+        }
+        self._apply_record(record)
 
         # Alert if multiple pages required
         if pages_fetched > 1:
@@ -129,17 +285,73 @@ class StateManager:
                 f"High data volume: {pages_fetched} pages fetched "
                 f"({total_records} records) - consider polling more frequently"
             )
-            self.state.last_pagination_warning = datetime.utcnow().isoformat()
             logger.warning(f"⚠️  {warning_msg}")
 
-        if success:
-            self.state.last_success_timestamp = datetime.utcnow().isoformat()
+        self._append_journal(record)
+        if self._pending_records >= self.COMPACT_EVERY:
+            self._save_state()
+
+    def _apply_record(self, record: Dict):
+        """Apply one update record (live or replayed from the journal) to the in-memory state"""
+        # Check up front so a malformed record is never half applied
+        missing = self._RECORD_FIELDS.difference(record)
+        if missing:
+            raise KeyError(f"journal record missing {sorted(missing)}")
+        now_iso = record["at"]
+        pages_fetched = record["pages_fetched"]
+        self.state.last_fetch_timestamp = record["fetch_timestamp"]
+        self.state.total_snapshots_sent += record["snapshots_sent"]
+        self.state.total_duplicates_skipped += record["duplicates_skipped"]
+
+        if record["last_snapshot_id"]:
+            self.state.last_snapshot_id = record["last_snapshot_id"]
+
+        if record["devices"]:
+            # Mark devices as most recently seen, then evict the oldest past the cap
+            tracked = self.state.devices_tracked
+            for device in record["devices"]:
+                if device in tracked:
+                    tracked.move_to_end(device)
+                else:
+                    tracked[device] = None
+            while len(tracked) > self.DEVICES_TRACKED_MAX:
+                tracked.popitem(last=False)
+
+        # Track pagination metrics
+        self.state.total_pages_fetched += pages_fetched
+        if pages_fetched > self.state.max_pages_in_single_fetch:
+            self.state.max_pages_in_single_fetch = pages_fetched
+        if pages_fetched > 1:
+            self.state.last_pagination_warning = now_iso
+
+        if record["success"]:
+            self.state.last_success_timestamp = now_iso
         else:
             self.state.total_errors += 1
-            self.state.last_error_timestamp = datetime.utcnow().isoformat()
-            self.state.last_error_message = error_message
+            self.state.last_error_timestamp = now_iso
+            self.state.last_error_message = record["error_message"]
 
-        self._save_state()
+        self.state.last_journal_seq = record["seq"]
+    
+    def record_run(
+        self,
+        last_fetch_time: datetime,
+        events_sent: int,
+        last_fetch_time_iso: Optional[str] = None
+    ):
+        """
+        Record a successful forwarder run.
+
+        Same signature as StateManagerAzure.record_run, so callers need not
+        know which state manager they hold. Pass last_fetch_time_iso when the
+        caller has already formatted the timestamp.
+        """
+        self.update_after_fetch(
+            fetch_timestamp=last_fetch_time_iso or last_fetch_time.isoformat(),
+            snapshots_sent=events_sent,
+            duplicates_skipped=0,
+            success=True
+        )
     
     def get_last_fetch_time(self) -> Optional[str]:
         """Get last successful fetch timestamp"""
@@ -155,12 +367,17 @@ class StateManager:
             "last_success": self.state.last_success_timestamp,
             "last_error": self.state.last_error_timestamp,
             "devices_count": len(self.state.devices_tracked),
-            "devices": self.state.devices_tracked
+            "devices": sorted(self.state.devices_tracked)
         }
     
+    def get_stats_json(self) -> bytes:
+        """Get current statistics as UTF-8 JSON bytes, ready for an HTTP response body"""
+        return orjson.dumps(self.get_stats())
+    
     def reset(self):
         """Reset all state (for testing)"""
         self.state = ForwarderState()
         self._recent_snapshot_ids = set()
+        self._recent_snapshot_order.clear()
         self._save_state()
         logger.info("State reset")
@@ -7,7 +7,9 @@ import logging
 import os
 from datetime import datetime, timedelta
 from typing import Optional
-from azure.data.tables import TableServiceClient, TableEntity
+
+import orjson
+from azure.data.tables import TableServiceClient, TableEntity, UpdateMode
 from azure.core.exceptions import ResourceNotFoundError
 
 logger = logging.getLogger(__name__)
@@ -49,12 +51,14 @@ class StateManagerAzure:
         # Use custom table name if provided, otherwise use default
         self.table_name = table_name or self.DEFAULT_TABLE_NAME
 
+        # Running total as last read from / written to the table (None = not read yet)
+        self._total_snapshots_sent: Optional[int] = None
+
         # Initialize Table Service Client
         self.table_service = TableServiceClient.from_connection_string(connection_string)
         self.table_client = self.table_service.get_table_client(self.table_name)
 
-        # Ensure table exists
-        self._ensure_table_exists()
+        # The table is created lazily, the first time a write finds it missing
 
         logger.info(f"StateManagerAzure initialized with table: {self.table_name}")
 
@@ -79,6 +83,7 @@ class StateManagerAzure:
                 partition_key=self.PARTITION_KEY,
                 row_key=self.ROW_KEY
             )
+            self._total_snapshots_sent = entity.get('total_snapshots_sent', 0)
 
             last_fetch_str = entity.get('last_fetch_time')
             if last_fetch_str:
@@ -91,6 +96,7 @@ class StateManagerAzure:
 
         except ResourceNotFoundError:
             logger.info("No existing state found, using default start time")
+            self._total_snapshots_sent = 0
             return self._default_start_time()
         except Exception as e:
             logger.error(f"Error reading state: {e}")
@@ -102,36 +108,51 @@ class StateManagerAzure:
         logger.info(f"Using default start time: {default}")
         return default
 
-    def update_state(self, last_fetch_time: datetime, snapshots_sent: int):
+    def update_state(
+        self,
+        last_fetch_time: datetime,
+        snapshots_sent: int,
+        last_fetch_time_iso: Optional[str] = None
+    ):
         """
         Update state after successful run.
 
         Args:
             last_fetch_time: Time of this successful fetch
             snapshots_sent: Number of snapshots sent in this run
+            last_fetch_time_iso: Optional pre-formatted ISO string of last_fetch_time
         """
         try:
-            # Try to get existing entity to preserve total count
-            try:
-                existing = self.table_client.get_entity(
-                    partition_key=self.PARTITION_KEY,
-                    row_key=self.ROW_KEY
-                )
-                total_snapshots = existing.get('total_snapshots_sent', 0) + snapshots_sent
-            except ResourceNotFoundError:
-                total_snapshots = snapshots_sent
+            # Use the running total cached by an earlier read; only fall back
+            # to a read-before-write if nothing has been read yet
+            if self._total_snapshots_sent is None:
+                try:
+                    existing = self.table_client.get_entity(
+                        partition_key=self.PARTITION_KEY,
+                        row_key=self.ROW_KEY
+                    )
+                    self._total_snapshots_sent = existing.get('total_snapshots_sent', 0)
+                except ResourceNotFoundError:
+                    self._total_snapshots_sent = 0
+            total_snapshots = self._total_snapshots_sent + snapshots_sent
 
             # Create/update entity
             entity = {
                 'PartitionKey': self.PARTITION_KEY,
                 'RowKey': self.ROW_KEY,
-                'last_fetch_time': last_fetch_time.isoformat(),
+                'last_fetch_time': last_fetch_time_iso or last_fetch_time.isoformat(),
                 'last_run_timestamp': datetime.utcnow().isoformat(),
                 'snapshots_sent_this_run': snapshots_sent,
                 'total_snapshots_sent': total_snapshots
             }
 
-            self.table_client.upsert_entity(entity)
+            try:
+                self.table_client.upsert_entity(entity, mode=UpdateMode.MERGE)
+            except ResourceNotFoundError:
+                # First write to a fresh storage account: create the table and retry once
+                self._ensure_table_exists()
+                self.table_client.upsert_entity(entity, mode=UpdateMode.MERGE)
+            self._total_snapshots_sent = total_snapshots
 
             logger.info(
                 f"State updated: last_fetch={last_fetch_time}, "
@@ -142,6 +163,29 @@ class StateManagerAzure:
             logger.error(f"Error updating state: {e}")
             raise
 
+    def record_run(
+        self,
+        last_fetch_time: datetime,
+        events_sent: int,
+        last_fetch_time_iso: Optional[str] = None
+    ):
+        """
+        Record a successful forwarder run.
+
+        Same signature as StateManager.record_run, so callers need not
+        know which state manager they hold.
+
+        Args:
+            last_fetch_time: Time of this successful fetch
+            events_sent: Number of events/items sent in this run
+            last_fetch_time_iso: Optional pre-formatted ISO string of last_fetch_time
+        """
+        self.update_state(
+            last_fetch_time=last_fetch_time,
+            snapshots_sent=events_sent,
+            last_fetch_time_iso=last_fetch_time_iso
+        )
+
     def get_statistics(self) -> dict:
         """
         Get current statistics from state.
@@ -154,6 +198,7 @@ class StateManagerAzure:
                 partition_key=self.PARTITION_KEY,
                 row_key=self.ROW_KEY
             )
+            self._total_snapshots_sent = entity.get('total_snapshots_sent', 0)
 
             return {
                 'last_fetch_time': entity.get('last_fetch_time'),
@@ -172,3 +217,12 @@ class StateManagerAzure:
         except Exception as e:
             logger.error(f"Error getting statistics: {e}")
             return {}
+
+    def get_statistics_json(self) -> bytes:
+        """
+        Get current statistics as JSON.
+
+        Returns:
+            bytes: UTF-8 encoded JSON of get_statistics(), ready for an HTTP response body
+        """
+        return orjson.dumps(self.get_statistics())
@@ -1,7 +1,9 @@
 import azure.functions as func
 import logging
 import os
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from app.config import get_config
 from app.microshare_client import MicroshareClient
 from app.eventhub_client import EventHubClient
@@ -10,69 +12,83 @@ from app.state_manager import StateManager
 
 app = func.FunctionApp()
 
+logger = logging.getLogger(__name__)
+
+# Lookback used when no previous fetch time is known
+_DEFAULT_LOOKBACK = timedelta(hours=24)
+
+# Whether we run in a real Azure Functions App environment. Valid Azure Storage
+# connection strings contain these markers; the environment does not change
+# during the lifetime of the worker process, so this is decided once at import.
+_AZURE_STORAGE_CONN = os.environ.get('AzureWebJobsStorage', '')
+_USE_AZURE_TABLES = bool(
+    _AZURE_STORAGE_CONN and
+    'AccountName=' in _AZURE_STORAGE_CONN and
+    'AccountKey=' in _AZURE_STORAGE_CONN
+)
+
 def get_state_manager(config, table_name: str):
     """
     Factory function to get the appropriate state manager.
     Uses Azure Table Storage if running in Azure Functions App (cloud),
     otherwise uses local file-based storage for VM/local deployment.
     """
-    # Check if running in real Azure Functions App environment
-    azure_storage_conn = os.environ.get('AzureWebJobsStorage', '')
-
-    # Valid Azure Storage connection strings contain these markers
-    is_valid_azure_storage = (
-        azure_storage_conn and
-        'AccountName=' in azure_storage_conn and
-        'AccountKey=' in azure_storage_conn
-    )
-
-    if is_valid_azure_storage:
-        logging.info(f"Using Azure Table Storage state manager (table: {table_name})")
+    if _USE_AZURE_TABLES:
+        logger.info("Using Azure Table Storage state manager (table: %s)", table_name)
         return StateManagerAzure(config, table_name=table_name)
     else:
-        logging.info(f"Using local file-based state manager (file: /var/lib/microshare-forwarder/{table_name}.json)")
+        logger.info("Using local file-based state manager (file: /var/lib/microshare-forwarder/%s.json)", table_name)
         # Use separate JSON files for each "table"
         return StateManager(state_file_path=f"/var/lib/microshare-forwarder/{table_name}.json")
 
+@lru_cache(maxsize=None)
+def _get_clients(state_table: str):
+    """
+    Get the (MicroshareClient, EventHubClient, state manager) triple for a forwarder.
+
+    Azure Functions reuses the Python worker across timer invocations, so the
+    clients are built once per process and state table, and their HTTP/AMQP
+    connections and table handles are kept warm between runs.
+    """
+    config = get_config()
+    return (
+        MicroshareClient(config),
+        EventHubClient(config),
+        get_state_manager(config, table_name=state_table)
+    )
+
 def normalize_datetime(dt) -> datetime:
-    """Convert various datetime formats to datetime object"""
+    """
+    Convert various datetime formats to a timezone-aware UTC datetime object.
+
+    Naive values (as written by older state) are assumed to be UTC.
+    """
+    if isinstance(dt, str):
+        dt = datetime.fromisoformat(dt)
     if isinstance(dt, datetime):
-        return dt
-    elif isinstance(dt, str):
-        return datetime.fromisoformat(dt)
+        return dt if dt.tzinfo is not None else dt.replace(tzinfo=timezone.utc)
     elif dt is None:
         # Default to 24 hours ago
-        from datetime import timedelta
-        return datetime.utcnow() - timedelta(hours=24)
+        return datetime.now(timezone.utc) - _DEFAULT_LOOKBACK
     else:
         raise ValueError(f"Cannot convert {type(dt)} to datetime")
 
-def update_state_unified(state_mgr, last_fetch_time: datetime, events_sent: int):
+def update_state_unified(
+    state_mgr,
+    last_fetch_time: datetime,
+    last_fetch_time_iso: str,
+    events_sent: int
+):
     """
     Unified state update that works with both state managers.
-    Handles API differences between StateManagerAzure and StateManager.
 
     Args:
         state_mgr: State manager instance (Azure or local file-based)
         last_fetch_time: Timestamp of last successful fetch
+        last_fetch_time_iso: Same timestamp, already ISO formatted
         events_sent: Number of events/items sent to Event Hub
     """
-    if isinstance(state_mgr, StateManagerAzure):
-        # Azure state manager expects datetime objects
-        state_mgr.update_state(
-            last_fetch_time=last_fetch_time,
-            snapshots_sent=events_sent  # Keep old param name for compatibility
-        )
-    elif isinstance(state_mgr, StateManager):
-        # Local state manager expects ISO strings
-        state_mgr.update_after_fetch(
-            fetch_timestamp=last_fetch_time.isoformat(),
-            snapshots_sent=events_sent,  # Keep old param name for compatibility
-            duplicates_skipped=0,
-            success=True
-        )
-    else:
-        raise ValueError(f"Unknown state manager type: {type(state_mgr)}")
+    state_mgr.record_run(last_fetch_time, events_sent, last_fetch_time_iso=last_fetch_time_iso)
 
 
 def run_forwarder(
@@ -91,56 +107,88 @@ def run_forwarder(
     Args:
         forwarder_name: Display name for logging (e.g., "Hourly Snapshot Forwarder")
         state_table: State table/file name (e.g., "snapshotstate", "peoplecounterstate")
-        fetch_function: Callable that fetches data. Signature: (ms_client, from_time, to_time) -> List
+        fetch_function: Callable that streams data one page (list of items) at a time.
+                        Signature: (ms_client, from_time, to_time) -> Iterable[List]
         config: Application configuration object
         data_type_name: Name for logging what was sent (e.g., "events", "snapshot responses")
 
     Returns:
         None (raises exception on failure)
     """
-    logging.info("="*80)
-    logging.info(f"{forwarder_name} - Starting")
-    logging.info("="*80)
+    logger.info("%s - Starting", forwarder_name, extra={"forwarder": forwarder_name})
 
     try:
-        # Initialize clients
-        ms_client = MicroshareClient(config)
-        eh_client = EventHubClient(config)
-
-        # Setup state management (auto-detects Azure vs local)
-        state_mgr = get_state_manager(config, table_name=state_table)
+        # Reuse clients and state management (auto-detects Azure vs local)
+        # across invocations of this worker process
+        ms_client, eh_client, state_mgr = _get_clients(state_table)
 
         # Get time window for fetch
         last_fetch_time = normalize_datetime(state_mgr.get_last_fetch_time())
-        current_time = datetime.utcnow()
+        current_time = datetime.now(timezone.utc)
+        current_time_iso = current_time.isoformat()
+
+        # Skip the run entirely if an earlier invocation already fetched up to
+        # (almost) now - the round trip would return nothing
+        min_window = timedelta(minutes=config.get('service', {}).get('min_window_minutes', 5))
+        if current_time - last_fetch_time < min_window:
+            logger.info(
+                "%s - Window since last fetch (%s) is below %s, skipping",
+                forwarder_name, last_fetch_time, min_window
+            )
+            return
 
         # Log configuration
         identity_filter = config.get('microshare', {}).get('identity', '')
-        logging.info(f"Fetching {data_type_name} since {last_fetch_time}")
-        logging.info(f"Identity filter: {identity_filter}")
+        logger.info("Fetching %s since %s (identity filter: %s)", data_type_name, last_fetch_time, identity_filter)
 
-        # Call the specific fetch function (people counter vs snapshot)
-        items = fetch_function(ms_client, last_fetch_time, current_time)
+        # Pipeline fetch -> send: while page N is being sent to Event Hub on the
+        # sender thread, the specific fetch function (people counter vs snapshot)
+        # is already fetching page N+1. Two pages are held here, plus at most
+        # MicroshareClient.MAX_CONCURRENT_QUERIES responses prefetched by the client
+        # (in flight or waiting behind the page being yielded).
+        #
+        # Delivery is at-least-once: if fetching a later location fails, pages
+        # already sent stay on Event Hub while last_fetch_time does not advance,
+        # so the next run sends them again. Consumers must tolerate duplicates.
+        item_count = 0
+        sent_count = 0
+        with ThreadPoolExecutor(max_workers=1) as sender:
+            pending_send = None
+            for page in fetch_function(ms_client, last_fetch_time, current_time):
+                if not page:
+                    continue
+                item_count += len(page)
+                if pending_send is not None:
+                    sent_count += pending_send.result()
+                pending_send = sender.submit(eh_client.send_events_batch, page)
+            if pending_send is not None:
+                sent_count += pending_send.result()
 
-        logging.info(f"Retrieved {len(items)} {data_type_name}")
+        logger.info("Retrieved %d %s", item_count, data_type_name)
 
-        # Send to Event Hub if we got data
-        if items:
-            sent_count = eh_client.send_events_batch(items)
-            logging.info(f"Sent {sent_count} {data_type_name} to Event Hub")
+        # Update state if we got data
+        if item_count:
+            logger.info("Sent %d %s to Event Hub", sent_count, data_type_name)
 
-            # Update state after successful send
-            update_state_unified(
-                state_mgr=state_mgr,
-                last_fetch_time=current_time,
-                events_sent=sent_count
-            )
+            # Update state after successful send. The events are already
+            # delivered, so a failure here must not fail the invocation: a host
+            # re-run would only fetch and send the same window again.
+            try:
+                update_state_unified(
+                    state_mgr=state_mgr,
+                    last_fetch_time=current_time,
+                    last_fetch_time_iso=current_time_iso,
+                    events_sent=sent_count
+                )
+            except Exception as e:
+                logger.error("%s - State update failed after sending, not retrying: %s",
+                             forwarder_name, e, exc_info=True)
+                return
 
-        logging.info(f"{forwarder_name} - SUCCESS")
+        logger.info("%s - SUCCESS", forwarder_name, extra={"forwarder": forwarder_name})
 
     except Exception as e:
-        logging.error(f"{forwarder_name} FAILED: {e}")
-        logging.exception("Exception details:")
+        logger.error("%s FAILED: %s", forwarder_name, e, exc_info=True)
         raise
 
 
@@ -170,7 +218,7 @@ def hourly_snapshot_forwarder(mytimer: func.TimerRequest) -> None:
         forwarder_name="Hourly Snapshot Forwarder",
         state_table="snapshotstate",
         fetch_function=lambda client, from_time, to_time:
-            client.get_snapshot_full_coverage(from_time, to_time),
+            client.iter_snapshot_full_coverage(from_time, to_time),
         config=config,
         data_type_name="snapshot API response(s)"
     )
@@ -205,7 +253,7 @@ def hourly_snapshot_forwarder(mytimer: func.TimerRequest) -> None:
 #         forwarder_name="People Counter Forwarder",
 #         state_table="peoplecounterstate",
 #         fetch_function=lambda client, from_time, to_time:
-#             client.get_people_counter_full_coverage(from_time, to_time),
+#             client.iter_people_counter_full_coverage(from_time, to_time),
 #         config=config,
 #         data_type_name="people counter events"
 #     )
@@ -0,0 +1,99 @@
+"""
+Tests for StateManager journal replay and compaction
+
+Run with: python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import orjson
+
+from app.state_manager import StateManager
+
+
+def _record(seq, snapshots_sent, fetch_timestamp):
+    return {
+        "seq": seq,
+        "at": "2025-11-14T10:00:00+00:00",
+        "fetch_timestamp": fetch_timestamp,
+        "snapshots_sent": snapshots_sent,
+        "duplicates_skipped": 0,
+        "last_snapshot_id": None,
+        "devices": None,
+        "success": True,
+        "error_message": None,
+        "pages_fetched": 1
+    }
+
+
+class StateManagerJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self._tmp.name)
+        self.state_path = self.dir / "state.json"
+        self.journal_path = self.dir / "state.json.log"
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _write_journal(self, *lines: bytes):
+        self.journal_path.write_bytes(b"".join(lines))
+
+    def test_journal_without_state_file_is_replayed(self):
+        manager = StateManager(str(self.state_path))
+        manager.update_after_fetch("2025-11-14T10:00:00", snapshots_sent=5, duplicates_skipped=0)
+        # Simulate losing the state file while the journal survives
+        os.remove(self.state_path)
+        self.assertTrue(self.journal_path.exists())
+
+        reloaded = StateManager(str(self.state_path))
+
+        self.assertEqual(reloaded.state.total_snapshots_sent, 5)
+        self.assertEqual(reloaded.state.last_fetch_timestamp, "2025-11-14T10:00:00")
+        # Compacted into a fresh state file
+        self.assertTrue(self.state_path.exists())
+        self.assertFalse(self.journal_path.exists())
+
+    def test_malformed_record_keeps_journal(self):
+        bad = _record(2, 7, "t2")
+        del bad["snapshots_sent"]
+        self._write_journal(
+            orjson.dumps(_record(1, 5, "t1")) + b"\n",
+            orjson.dumps(bad) + b"\n",
+            orjson.dumps(_record(3, 9, "t3")) + b"\n",
+        )
+
+        manager = StateManager(str(self.state_path))
+
+        # Applied up to the malformed record, nothing half applied
+        self.assertEqual(manager.state.total_snapshots_sent, 5)
+        self.assertEqual(manager.state.last_fetch_timestamp, "t1")
+        # Journal moved aside intact rather than deleted
+        self.assertFalse(self.journal_path.exists())
+        kept = list(self.dir.glob("state.json.log.corrupt-*"))
+        self.assertEqual(len(kept), 1)
+        seqs = [orjson.loads(line)["seq"] for line in kept[0].read_bytes().splitlines()]
+        self.assertEqual(seqs, [1, 2, 3])
+
+    def test_torn_final_record_is_dropped(self):
+        self._write_journal(
+            orjson.dumps(_record(1, 5, "t1")) + b"\n",
+            orjson.dumps(_record(2, 7, "t2"))[:20],
+        )
+
+        manager = StateManager(str(self.state_path))
+
+        self.assertEqual(manager.state.total_snapshots_sent, 5)
+        self.assertFalse(self.journal_path.exists())
+        self.assertEqual(list(self.dir.glob("state.json.log.corrupt-*")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()